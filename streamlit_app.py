@@ -1,6 +1,7 @@
 import streamlit as st
-import pandas as pd
+import polars as pl
 import math
+import os
 from pathlib import Path
 import altair as alt
 
@@ -21,30 +22,112 @@ def get_electricity_data():
 
     # Instead of a CSV on disk, you could read from an HTTP endpoint here too.
     DATA_FILENAME = Path(__file__).parent/'data/electricity_data.csv'
-    raw_df = pd.read_csv(DATA_FILENAME)
 
-    # remove invalid measurements, "--", "ie", or blanks
-    raw_df.replace("--",pd.NA,inplace=True)
-    raw_df.replace("ie",pd.NA,inplace=True)
-    raw_df.replace("",pd.NA,inplace=True)
+    # reuse the processed table from a previous run unless the CSV or this loader has changed since
+    cache_path = DATA_FILENAME.with_suffix('.parquet')
+    source_mtime = max(DATA_FILENAME.stat().st_mtime, Path(__file__).stat().st_mtime)
+    if cache_path.exists() and cache_path.stat().st_mtime >= source_mtime:
+        try:
+            return pl.read_parquet(cache_path).to_pandas()
+        except (OSError, pl.exceptions.PolarsError):
+            pass # unreadable cache, rebuild it below
+
+    # peek at the header to find the year columns so they are parsed straight to floats
+    years = [col for col in pl.read_csv(DATA_FILENAME, n_rows=0).columns if col.isdigit()]
+
+    # remove invalid measurements, "--", "ie", "NA", or blanks, while scanning the file
+    lf = pl.scan_csv(
+        DATA_FILENAME,
+        null_values=['--', 'ie', 'NA', ''],
+        schema_overrides={'Country': pl.String, 'Features': pl.String, 'Region': pl.String,
+                          **{year: pl.Float32 for year in years}},
+        infer_schema=False
+    )
 
     # cleanup strings
-    raw_df['Country']=raw_df['Country'].str.strip()
-    raw_df['Features']=raw_df['Features'].str.strip()
+    lf = lf.with_columns(pl.col('Country', 'Features', 'Region').str.strip_chars())
+    raw_df = lf.sort('Country', 'Region', 'Features').collect()
+
+    # the file already has a block of feature rows per country with a column for each year,
+    # so transpose each block into country, year, measurement format instead of melting and pivoting.
+    # This needs exactly one row per feature in every block, otherwise match measurements by label.
+    features = raw_df['Features'].unique().sort().to_list()
+    complete = (
+        raw_df.group_by('Country', 'Region').len()['len'].eq(len(features)).all()
+        and not raw_df.select('Country', 'Region', 'Features').is_duplicated().any()
+    )
+    if complete:
+        # country and region repeat for every year, so store them as categories
+        keys = raw_df.select(pl.col('Country', 'Region').cast(pl.Categorical)).unique(maintain_order=True)
+        values = raw_df.select(years).to_numpy()
+        values = values.reshape(keys.height, len(features), len(years)).transpose(0, 2, 1)
+
+        df = keys.select(pl.all().repeat_by(len(years)).explode()).with_columns(
+            Year=pl.Series(years*keys.height).cast(pl.Int16)
+        ).hstack(pl.DataFrame(values.reshape(-1, len(features)), schema=features, nan_to_null=True))
+        df = df.filter(~pl.all_horizontal(pl.col(features).is_null()))#drop years without measurements
+    else:
+        df = raw_df.unpivot(index=['Country', 'Features', 'Region'], variable_name='Year', value_name='Value')
+        df = df.drop_nulls('Value').pivot(
+            on='Features',
+            index=['Country', 'Region', 'Year'],
+            values='Value',
+            aggregate_function='mean',
+            sort_columns=True
+        ).with_columns(
+            pl.col('Country', 'Region').cast(pl.Categorical),
+            pl.col('Year').cast(pl.Int16),
+            pl.exclude('Country', 'Region', 'Year').cast(pl.Float32)
+        ).sort('Country', 'Region', 'Year')
+
+    # write to a temporary file first so other server processes never read a partial cache
+    tmp_path = cache_path.with_suffix(f'.{os.getpid()}.tmp')
+    try:
+        df.write_parquet(tmp_path, compression='zstd')
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        tmp_path.unlink(missing_ok=True) # read-only deployments just skip the on-disk cache
+
+    return df.to_pandas()
+
+@st.cache_resource
+def get_data_range():
+    """Grab the countries and the first and last year covered by the data.
+
+    These only depend on the cached data, so there is no need to rescan the
+    table every time a widget changes and the script reruns. Like the lookup
+    helper below, the result is read-only and shared as is instead of being
+    copied out of the cache on every rerun.
+    """
+    df = get_electricity_data()
+    return tuple(df['Country'].unique()), int(df['Year'].min()), int(df['Year'].max())
 
-    # transform table into country, year, measurement format rather than a column for each year
-    raw_df=raw_df.melt(id_vars=['Country','Features','Region'], var_name='Year', value_name='Value')
-    raw_df['Year']=raw_df['Year'].astype('int')
-    raw_df.dropna(inplace=True)#drop NaN measurements
-    raw_df['Value']=raw_df['Value'].astype('float')
+@st.cache_resource
+def get_lookup():
+    """Grab the electricity measurements indexed and sorted by country and year.
 
-    # pivot and create columns for each measurement type by year
-    raw_df=raw_df.pivot_table(values='Value', index=['Country', 'Region', 'Year'], columns='Features')
-    raw_df.reset_index(inplace=True)
+    Looking up a (country, year) pair in a sorted index is a binary search
+    rather than a scan over the whole table.
+    """
+    return get_electricity_data().drop(columns='Region').set_index(['Country', 'Year']).sort_index()
 
-    return raw_df
+@st.cache_resource
+def get_feature_labels():
+    """Grab the display label of each measured feature, in table order."""
+    return {feature: feature.replace("_", " ").title() for feature in get_lookup().columns}
 
 elec_df = get_electricity_data()
+LOOKUP = get_lookup()
+COUNTRIES, MIN_YEAR, MAX_YEAR = get_data_range()
+FEATURE_LABELS = get_feature_labels()
+
+# Features whose checkboxes go in the left column, the others go in the right one
+LEFT_COL_FEATURES = frozenset({'imports', 'exports', 'net imports', 'distribution losses'})
+
+# Units, long units and value suffix of features not measured in billions of kWh
+FEATURE_UNITS = {
+    'installed capacity': ('kW', 'millions of kW', 'M'),
+}
 
 # -----------------------------------------------------------------------------
 # Draw the actual page
@@ -73,45 +156,53 @@ st.dataframe(elec_df)
 st.header('Settings', divider='gray')
 
 # Year selection slider
-min_value = elec_df['Year'].min()
-max_value = elec_df['Year'].max()
 from_year, to_year = st.slider(
     'Which years are you interested in?',
-    min_value=min_value,
-    max_value=max_value,
-    value=[min_value, max_value]
+    min_value=MIN_YEAR,
+    max_value=MAX_YEAR,
+    value=[MIN_YEAR, MAX_YEAR]
 )
 
 # Country selection multiselect
-countries = elec_df['Country'].unique()
 selected_countries = st.multiselect(
     'Which countries would you like to view?',
-    countries,
+    COUNTRIES,
     ['United States', 'China', 'India', 'Canada']
 )
 
 # Feature selection checkboxes in two columns
 '''Select features to plot'''
-available_features = [col for col in elec_df.columns if col not in ['Country', 'Region', 'Year']]
+available_features = list(FEATURE_LABELS)
 selected_features = []
 
 # Create two columns for feature checkboxes
 col1, col2 = st.columns(2)
 for i, feature in enumerate(available_features):
     # Alternate placing checkboxes in col1 and col2
-    with (col1 if feature in ['imports', 'exports','net imports', 'distribution losses'] else col2):
-        if st.checkbox(feature.replace("_", " ").title(), key=f"feature_{feature}"):
+    with (col1 if feature in LEFT_COL_FEATURES else col2):
+        if st.checkbox(FEATURE_LABELS[feature], key=f"feature_{feature}"):
             selected_features.append(feature)
 
-# Filter the data
-filtered_elec_df = elec_df[
-    (elec_df['Country'].isin(selected_countries))
-    & (elec_df['Year'] <= to_year)
-    & (from_year <= elec_df['Year'])
-]
+# Filter the data and look up the first and last year of each selected country.
+# These only depend on the country and year selection, so keep them in the session
+# and skip the work when the script reruns because a feature or scale was toggled.
+# LOOKUP is shared through st.cache_resource, so its id changes whenever the data is reloaded.
+selection_key = (id(LOOKUP), tuple(sorted(selected_countries)), from_year, to_year)
+if st.session_state.get('_selection_key') != selection_key:
+    filtered_elec_df = elec_df[
+        (elec_df['Country'].isin(selected_countries))
+        & (elec_df['Year'].between(from_year, to_year))
+    ]
+
+    # countries without a row for either year get NaN measurements
+    first_year = LOOKUP.reindex([(country, from_year) for country in selected_countries]).droplevel('Year')
+    last_year = LOOKUP.reindex([(country, to_year) for country in selected_countries]).droplevel('Year')
+    growth_df = 100*(last_year-first_year) / first_year
 
-first_year = filtered_elec_df[filtered_elec_df['Year'] == from_year]
-last_year = filtered_elec_df[filtered_elec_df['Year'] == to_year]
+    st.session_state['_selection_key'] = selection_key
+    st.session_state['_selection'] = (filtered_elec_df, first_year, last_year, growth_df)
+
+filtered_elec_df, first_year, last_year, growth_df = st.session_state['_selection']
 
 # Plot section
 st.header('Plots', divider='gray')
@@ -119,22 +210,19 @@ st.header('Plots', divider='gray')
 
 # Loop through selected features to create separate plots
 for feature in selected_features:
-    units='kWh'
-    long_units='billions of kWh'
-    short_units="B"
-    if feature=="installed capacity":
-        units='kW'
-        long_units='millions of kW'
-        short_units="M"
-    st.subheader(f'{feature.replace("_", " ").title()} ({long_units})', divider='gray')
+    units, long_units, short_units = FEATURE_UNITS.get(feature, ('kWh', 'billions of kWh', 'B'))
+    st.subheader(f'{FEATURE_LABELS[feature]} ({long_units})', divider='gray')
     
     # Create the line chart for each selected feature
     log_scale = st.checkbox("Logarithmic scale", key=f"{feature}_log")
     y_axis_scale = alt.Scale(type='log') if log_scale else alt.Scale(type='linear')
 
-    line_chart = alt.Chart(filtered_elec_df).mark_line().encode(
+    # Only send the plotted columns and measured years to the browser
+    chart_df = filtered_elec_df[['Year', 'Country', feature]].dropna(subset=[feature])
+
+    line_chart = alt.Chart(chart_df).mark_line().encode(
         x=alt.X('Year:O', title='Year'),
-        y=alt.Y(f'{feature}:Q', scale=y_axis_scale, title=f'{feature.replace("_", " ").title()} ({long_units})'),
+        y=alt.Y(f'{feature}:Q', scale=y_axis_scale, title=f'{FEATURE_LABELS[feature]} ({long_units})'),
         color='Country:N'
     ).properties(
         width=700,
@@ -143,7 +231,7 @@ for feature in selected_features:
     
     st.altair_chart(line_chart, use_container_width=True)
 
-    st.subheader(f'{feature.replace("_", " ").title()} ({units}) in {to_year}\nPercent difference compared to {from_year}', divider='gray')
+    st.subheader(f'{FEATURE_LABELS[feature]} ({units}) in {to_year}\nPercent difference compared to {from_year}', divider='gray')
 
     cols = st.columns(4)
 
@@ -151,19 +239,19 @@ for feature in selected_features:
         col = cols[i % len(cols)]
 
         with col:
-            first_data = first_year[first_year['Country'] == country][feature].iat[0]
-            last_data = last_year[last_year['Country'] == country][feature].iat[0]
+            first_data = first_year.at[country, feature]
+            last_data = last_year.at[country, feature]
 
-            if math.isnan(first_data):
+            if math.isnan(first_data) or math.isnan(last_data):
                 growth = 'n/a'
                 delta_color = 'off'
             else:
-                growth = f'{100*(last_data-first_data) / first_data:,.1f}%'
+                growth = f'{growth_df.at[country, feature]:,.1f}%'
                 delta_color = 'normal'
 
             st.metric(
                 label=f'{country}',
-                value=f'{last_data:,.0f}{short_units}',
+                value='n/a' if math.isnan(last_data) else f'{last_data:,.0f}{short_units}',
                 delta=growth,
                 delta_color=delta_color
             )